@@ -1,12 +1,66 @@
-from screendown import ScreenshotDownload, SSDownloadException
-from PyQt5 import QtWidgets
-from gui import *
+from screendown import LinkSet, ScreenshotDownload
+from PyQt5 import QtCore, QtWidgets
+from PyQt5.QtWidgets import QFileDialog
+from gui import Ui_MainWindow
 import os, sys
 import time
-import requests
+import io
+
+
+class LinkLoader(QtCore.QThread):
+    """
+    Reads links from a file or a text in chunks of lines on a background
+    thread, validating and de-duplicating them into a LinkSet as they arrive.
+
+    Signals
+    -------
+    chunk_loaded(str, list, dict):
+        the text of a chunk, the (url, reason) tuples of the links it rejected
+        and the counts of the LinkSet so far
+    loaded(LinkSet):
+        the complete LinkSet once all chunks are read
+    failed(str):
+        the error message if the source couldn't be read
+    """
+
+    CHUNK_SIZE = 256 * 1024
+
+    chunk_loaded = QtCore.pyqtSignal(str, list, dict)
+    loaded = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, filename: str | None = None, text: str | None = None):
+        super().__init__()
+        self.filename = filename
+        self.text = text
+
+    def open(self):
+        if self.filename is not None:
+            return open(self.filename, "r")
+        return io.StringIO(self.text)
+
+    def run(self):
+        links = LinkSet()
+        try:
+            with self.open() as f:
+                while not self.isInterruptionRequested():
+                    lines = f.readlines(self.CHUNK_SIZE)
+                    if not lines:
+                        break
+                    text, rejected = "".join(lines), []
+                    links.add(text, rejected)
+                    self.chunk_loaded.emit(text, rejected, links.counts())
+        except (OSError, UnicodeDecodeError) as e:
+            self.failed.emit(str(e))
+            return
+        if not self.isInterruptionRequested():
+            self.loaded.emit(links)
 
 
 class App(QtWidgets.QWidget):
+    # Rejected links logged per opened file, the rest are only counted
+    MAX_LOGGED_REJECTED = 100
+
     def __init__(self):
         self.dir = os.getcwd()
         self.app = QtWidgets.QApplication(sys.argv)
@@ -19,6 +73,16 @@ class App(QtWidgets.QWidget):
         self.ui.submit_button.clicked.connect(self.download)
         self.ui.load_line.returnPressed.connect(self.open_file)
         self.ui.load_line.returnPressed.connect(self.set_dir)
+        self.ui.links_text.textChanged.connect(self.links_edited)
+        self.links = LinkSet()
+        self.loader = None
+        self.loaders = set()
+        self.logged_rejected = 0
+        self.validate_timer = QtCore.QTimer(self.Window)
+        self.validate_timer.setSingleShot(True)
+        self.validate_timer.setInterval(500)
+        self.validate_timer.timeout.connect(self.validate_links)
+        self.show_counts(self.links.counts())
         super().__init__()
 
     def log(self, message):
@@ -26,14 +90,112 @@ class App(QtWidgets.QWidget):
         now = time.strftime("%H:%M:%S", local_time)
         self.ui.logs_text.append(f"[{now}] {message}")
 
+    def show_counts(self, counts: dict):
+        self.ui.links_count_label.setText(
+            f"Valid: {counts['valid']}  Invalid: {counts['invalid']}  "
+            f"Duplicates: {counts['duplicate']}"
+        )
+
+    def start_loader(self, loader: LinkLoader, append: bool):
+        """
+        Replaces the running loader, if any, with the given one.
+
+        Parameters
+        ----------
+        loader : LinkLoader
+            the loader to start
+        append : bool
+            whether the loaded text is appended to the links editor and the
+            rejected links are logged
+        """
+        self.stop_loader()
+        self.loader = loader
+        self.loaders.add(loader)
+        self.links = None
+        self.logged_rejected = 0
+        loader.chunk_loaded.connect(
+            lambda text, rejected, counts: self.chunk_loaded(
+                loader, text, rejected, counts, append
+            )
+        )
+        loader.loaded.connect(lambda links: self.links_loaded(loader, links, append))
+        loader.failed.connect(lambda message: self.load_failed(loader, message))
+        loader.finished.connect(lambda: self.loaders.discard(loader))
+        loader.finished.connect(loader.deleteLater)
+        loader.start()
+
+    def stop_loader(self):
+        if self.loader is not None:
+            self.loader.requestInterruption()
+            self.loader = None
+
+    def chunk_loaded(
+        self,
+        loader: LinkLoader,
+        text: str,
+        rejected: list,
+        counts: dict,
+        append: bool,
+    ):
+        if loader is not self.loader:
+            return
+        if append:
+            # The text is kept as read, so rejected links stay visible and
+            # validating the edited text again gives the same counts.
+            self.ui.links_text.blockSignals(True)
+            self.ui.links_text.appendPlainText(text.rstrip("\n"))
+            self.ui.links_text.blockSignals(False)
+            for url, reason in rejected:
+                if self.logged_rejected >= self.MAX_LOGGED_REJECTED:
+                    break
+                self.logged_rejected += 1
+                self.log(f"Skipped {reason} link: {url}")
+        self.show_counts(counts)
+
+    def links_loaded(self, loader: LinkLoader, links: LinkSet, append: bool):
+        if loader is not self.loader:
+            return
+        self.loader = None
+        self.links = links
+        if append:
+            self.ui.links_text.setReadOnly(False)
+            counts = links.counts()
+            self.log(
+                f"File opened successfully, {counts['valid']} valid links, "
+                f"{counts['invalid']} invalid and {counts['duplicate']} duplicates "
+                "skipped"
+            )
+
+    def load_failed(self, loader: LinkLoader, message: str):
+        if loader is not self.loader:
+            return
+        self.loader = None
+        self.links = LinkSet()
+        self.ui.links_text.setReadOnly(False)
+        self.log("Couldn't open a file")
+
+    def links_edited(self):
+        if self.loading_file():
+            return
+        self.stop_loader()
+        self.links = None
+        self.validate_timer.start()
+
+    def validate_links(self):
+        self.start_loader(LinkLoader(text=self.ui.links_text.toPlainText()), False)
+
+    def loading_file(self):
+        return self.loader is not None and self.loader.filename is not None
+
     def open_file(self):
-        filename = self.ui.load_line.text()
-        try:
-            with open(filename, "r") as f:
-                self.ui.links_text.setPlainText(f.read())
-            self.log("File opened successfully")
-        except:
-            self.log("Couldn't open a file")
+        self.validate_timer.stop()
+        # Edits would abandon the file load, so the editor is read-only until
+        # the load has finished.
+        self.ui.links_text.setReadOnly(True)
+        self.ui.links_text.blockSignals(True)
+        self.ui.links_text.clear()
+        self.ui.links_text.blockSignals(False)
+        self.start_loader(LinkLoader(filename=self.ui.load_line.text()), True)
 
     def load_file(self):
         filename, _ = QFileDialog.getOpenFileName(
@@ -53,8 +215,16 @@ class App(QtWidgets.QWidget):
             self.set_dir()
 
     def download(self):
-        urls = self.ui.links_text.toPlainText()
-        obj = ScreenshotDownloadApp(urls, self.dir, self.ui.logs_text)
+        if self.links is None:
+            if self.loading_file():
+                self.log("Links are still loading")
+                return
+            self.validate_timer.stop()
+            self.stop_loader()
+            self.links = LinkSet()
+            self.links.add(self.ui.links_text.toPlainText())
+            self.show_counts(self.links.counts())
+        obj = ScreenshotDownloadApp(self.links.links, self.dir, self.ui.logs_text)
         obj.run()
 
     def run(self):
@@ -72,34 +242,9 @@ class ScreenshotDownloadApp(ScreenshotDownload):
         now = time.strftime("%H:%M:%S", local_time)
         self.text_box.append(f"[{now}] {message}")
 
-    def fetch_image_sources(self):
-        img_sources = super().fetch_image_sources()
-        for url in set(map(lambda x: self.extend_protocol(x), self.urls)).difference(
-            set(map(lambda x: x[1], img_sources))
-        ):
-            self.log(f"Failed to parse {url}")
-        return img_sources
-        
-    def save_image(self, img_title: str, content: bytes, url: str):
-        try:
-            with open(os.path.join(self.dir_name, f"{img_title}.png"), "wb") as f:
-                f.write(content)
-            self.log(f"File {url} saved as {img_title}")
-        except Exception as e:
-            self.log(f"Error while saving to file: {url}")
-                
-    def download_and_save(self, img_sources: list[tuple]):
-        for ind, (img, url) in enumerate(img_sources):
-            img_title = f"image_{ind}" if ind else "image"
-            try:
-                request = requests.get(img)
-                if request.status_code != 200:
-                    raise SSDownloadException
-            except:
-                self.log(f"Can't download image: {url}")
-                continue
-
-            self.save_image(img_title, request.content, url)
+    def report(self, url: str, status: str, message: str):
+        if status not in ("parsed", "cached"):
+            self.log(message)
 
     def run(self):
         super().run()
@@ -0,0 +1,482 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from screendown import SCHEDULES, ScreenshotDownload
+from transport import DEFAULT_CONCURRENCY, TRANSPORTS, HttpxTransport, get_transport
+import contextlib
+import statistics
+import subprocess
+import threading
+import tempfile
+import types
+import time
+import sys
+import os
+
+
+HEADLESS_MODULES = ("screendown", "transport", "dedup")
+HEAVY_IMPORTS = ("bs4", "requests", "PyQt5", "asyncio", "multiprocessing")
+CHUNK_SIZE = 256 * 1024
+
+
+def stand_in_body(settings, path: str, address: tuple):
+    """
+    Returns the body and the content type the stand-in servers send for the
+    given path.
+
+    Every path not starting with /img is a page whose screenshot-image tag
+    points back to /img on the server at address. Every large_every-th
+    image is large_size bytes, the others are image_size bytes.
+    """
+    if path.startswith("/img"):
+        ind = int(path.rsplit("/", 1)[-1])
+        large = settings.large_every and ind % settings.large_every == 0
+        size = settings.large_size if large else settings.image_size
+        return b"\x89PNG" + bytes(size), "image/png"
+
+    host, port = address
+    body = (
+        "<html><img id='screenshot-image' "
+        f"src='http://{host}:{port}/img{path}'></html>"
+    ).encode()
+    return body, "text/html"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves fake Lightshot pages and images over HTTP/1.1, see stand_in_body.
+
+    Each response waits latency seconds to stand in for the network round
+    trip, plus the body size divided by bandwidth to stand in for the
+    transfer.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def get_body(self):
+        return stand_in_body(self.server, self.path, self.server.server_address[:2])
+
+    def send_head(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        self.send_head(*self.get_body())
+
+    def do_GET(self):
+        body, content_type = self.get_body()
+        time.sleep(self.server.latency)
+        self.send_head(body, content_type)
+        try:
+            for start in range(0, len(body), CHUNK_SIZE):
+                chunk = body[start : start + CHUNK_SIZE]
+                time.sleep(len(chunk) / self.server.bandwidth)
+                self.wfile.write(chunk)
+        except ConnectionError:
+            # The client aborted the transfer, e.g. because of max_bytes.
+            self.close_connection = True
+
+
+class StandInServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections opened in a burst, which
+    # shows up as one-second SYN retransmits in the results.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+@contextlib.contextmanager
+def stand_in_server(
+    latency: float = 0.01,
+    bandwidth: float = 50e6,
+    image_size: int = 50_000,
+    large_size: int = 5_000_000,
+    large_every: int = 0,
+):
+    """
+    Runs the stand-in server in a background thread and yields its address.
+    """
+    server = StandInServer(("127.0.0.1", 0), StandInHandler)
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.image_size = image_size
+    server.large_size = large_size
+    server.large_every = large_every
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.server_address[:2]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class H2StandInProtocol:
+    """
+    Serves the same pages and images as StandInHandler over HTTP/2 without
+    TLS, to clients connecting with prior knowledge.
+
+    Every stream is answered by its own task, so the responses on one
+    connection are multiplexed instead of waiting for each other.
+    """
+
+    def __init__(self, settings) -> None:
+        import h2.config
+        import h2.connection
+
+        self.settings = settings
+        self.connection = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        # Events of the streams waiting for the client to open its window
+        self.window_open = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connection.initiate_connection()
+        self.flush()
+
+    def connection_lost(self, exc):
+        self.wake(list(self.window_open))
+
+    def eof_received(self):
+        return False
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def flush(self):
+        data = self.connection.data_to_send()
+        if data and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def wake(self, stream_ids):
+        for stream_id in stream_ids:
+            if stream_id in self.window_open:
+                self.window_open[stream_id].set()
+
+    def data_received(self, data: bytes):
+        import asyncio
+        import h2.events
+        import h2.exceptions
+
+        try:
+            events = self.connection.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.flush()
+            self.transport.close()
+            return
+
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self.window_open[event.stream_id] = asyncio.Event()
+                asyncio.ensure_future(
+                    self.respond(event.stream_id, dict(event.headers))
+                )
+            elif isinstance(event, h2.events.WindowUpdated):
+                if event.stream_id == 0:
+                    self.wake(list(self.window_open))
+                else:
+                    self.wake([event.stream_id])
+            elif isinstance(event, h2.events.RemoteSettingsChanged):
+                self.wake(list(self.window_open))
+            elif isinstance(event, h2.events.StreamReset):
+                self.wake([event.stream_id])
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.transport.close()
+        self.flush()
+
+    async def respond(self, stream_id: int, headers: dict):
+        import asyncio
+        import h2.exceptions
+
+        address = self.transport.get_extra_info("sockname")[:2]
+        body, content_type = stand_in_body(self.settings, headers[":path"], address)
+        head = headers[":method"] == "HEAD"
+        try:
+            await asyncio.sleep(self.settings.latency)
+            self.connection.send_headers(
+                stream_id,
+                [
+                    (":status", "200"),
+                    ("content-type", content_type),
+                    ("content-length", str(len(body))),
+                ],
+                end_stream=head,
+            )
+            self.flush()
+            if head:
+                return
+            for start in range(0, len(body), CHUNK_SIZE):
+                chunk = body[start : start + CHUNK_SIZE]
+                await asyncio.sleep(len(chunk) / self.settings.bandwidth)
+                await self.send_data(stream_id, chunk)
+            self.connection.end_stream(stream_id)
+            self.flush()
+        except (h2.exceptions.ProtocolError, ConnectionError):
+            # The client reset the stream, e.g. because of max_bytes, or left.
+            pass
+        finally:
+            self.window_open.pop(stream_id, None)
+
+    async def send_data(self, stream_id: int, data: bytes):
+        """
+        Sends the data as fast as the flow control windows of the client allow.
+        """
+        while data:
+            if self.transport.is_closing():
+                raise ConnectionError("Connection closed")
+            size = min(
+                self.connection.local_flow_control_window(stream_id),
+                self.connection.max_outbound_frame_size,
+                len(data),
+            )
+            if size <= 0:
+                self.window_open[stream_id].clear()
+                await self.window_open[stream_id].wait()
+                continue
+            self.connection.send_data(stream_id, data[:size])
+            self.flush()
+            data = data[size:]
+
+
+@contextlib.contextmanager
+def h2_stand_in_server(
+    latency: float = 0.01,
+    bandwidth: float = 50e6,
+    image_size: int = 50_000,
+    large_size: int = 5_000_000,
+    large_every: int = 0,
+):
+    """
+    Runs the HTTP/2 stand-in server on an event loop in a background thread
+    and yields its address.
+
+    Raises
+    ------
+    ImportError
+        if the h2 package is not installed
+    """
+    import asyncio
+    import h2.connection
+
+    settings = types.SimpleNamespace(
+        latency=latency,
+        bandwidth=bandwidth,
+        image_size=image_size,
+        large_size=large_size,
+        large_every=large_every,
+    )
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        loop.create_server(lambda: H2StandInProtocol(settings), "127.0.0.1", 0)
+    )
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.sockets[0].getsockname()[:2]
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            loop.run_until_complete(asyncio.wait(tasks))
+        loop.close()
+
+
+# The stand-in each transport is benchmarked against, with the transport
+# arguments it needs. httpx only speaks HTTP/2 on http:// urls with prior
+# knowledge, so the http2 transport gets an h2c server to multiplex on.
+STAND_INS = {
+    HttpxTransport.name: (h2_stand_in_server, {"http1": False}),
+}
+
+
+class QuietScreenshotDownload(ScreenshotDownload):
+    def report(self, url: str, status: str, message: str):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status == "saved":
+            self.saved_at.append(time.perf_counter())
+
+    def download_and_save(self, img_sources: list[tuple]):
+        self.download_start = time.perf_counter()
+        super().download_and_save(img_sources)
+
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench_transport(
+    name: str,
+    urls: list,
+    concurrency: int,
+    transport_options: dict | None = None,
+    **options,
+):
+    """
+    Runs a full download of the given urls with the named transport.
+
+    transport_options are passed to the transport class, options to
+    ScreenshotDownload.
+
+    Returns
+    -------
+    dict
+        the elapsed seconds, the p50 and p95 seconds from the start of the
+        image phase until an image was saved, and the reported statuses
+    """
+    with tempfile.TemporaryDirectory() as dir:
+        with get_transport(
+            name, concurrency=concurrency, **(transport_options or {})
+        ) as transport:
+            obj = QuietScreenshotDownload(urls, dir, transport=transport, **options)
+            obj.statuses = {}
+            obj.saved_at = []
+            start = time.perf_counter()
+            obj.run()
+            elapsed = time.perf_counter() - start
+
+    saved = [saved_at - obj.download_start for saved_at in obj.saved_at]
+    return {
+        "seconds": elapsed,
+        "p50": percentile(saved, 0.5),
+        "p95": percentile(saved, 0.95),
+        "statuses": obj.statuses,
+    }
+
+
+def import_times(module: str):
+    """
+    Imports the module in a fresh interpreter with -X importtime.
+
+    Returns
+    -------
+    dict
+        a dict mapping every imported module to its cumulative import time
+        in microseconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def check_import_time(modules: list, budget_ms: float, runs: int = 5):
+    """
+    Prints the median cold import time of each module against the budget.
+
+    Returns
+    -------
+    bool
+        True if every module imports within the budget and without any of
+        HEAVY_IMPORTS, False otherwise
+    """
+    ok = True
+    print(f"{'module':<12} {'ms':>8} {'budget':>8}  heavy imports")
+    for module in modules:
+        samples = [import_times(module) for _ in range(runs)]
+        elapsed = statistics.median(times[module] for times in samples) / 1000
+        heavy = [name for name in HEAVY_IMPORTS if name in samples[0]]
+        ok = ok and elapsed <= budget_ms and not heavy
+        print(f"{module:<12} {elapsed:>8.1f} {budget_ms:>8.1f}  {', '.join(heavy)}")
+    return ok
+
+
+def main(
+    transports: list,
+    count: int,
+    concurrency: int,
+    latency: float,
+    large_every: int = 0,
+    **options,
+):
+    print(f"{'transport':<10} {'seconds':>8} {'p50':>7} {'p95':>7}  statuses")
+    for name in transports:
+        server, transport_options = STAND_INS.get(name, (stand_in_server, {}))
+        try:
+            with server(latency, large_every=large_every) as (host, port):
+                # The "prnt.sc" user info passes is_valid_domain, which only
+                # checks that the domain appears somewhere in the network
+                # location, while the request still goes to the stand-in
+                # server. The bench breaks if that check gets stricter.
+                urls = [
+                    f"http://prnt.sc@{host}:{port}/{ind:06}" for ind in range(count)
+                ]
+                result = bench_transport(
+                    name, urls, concurrency, transport_options, **options
+                )
+        except ImportError as e:
+            print(f"{name:<10} skipped: {e}")
+            continue
+        print(
+            f"{name:<10} {result['seconds']:>8.3f} {result['p50']:>7.3f} "
+            f"{result['p95']:>7.3f}  {result['statuses']}"
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark transport backends")
+    parser.add_argument(
+        "--transport", action="append", choices=TRANSPORTS, dest="transports"
+    )
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument(
+        "--large-every", type=int, default=0, help="make every n-th image large"
+    )
+    parser.add_argument("--max-bytes", type=int, default=None)
+    parser.add_argument(
+        "--schedule",
+        choices=SCHEDULES,
+        default="input",
+        help="order of image transfers; smallest and largest send a HEAD "
+        "request per image first and need a concurrency above 1",
+    )
+    parser.add_argument(
+        "--import-time",
+        action="store_true",
+        help="check cold import times of the headless modules instead",
+    )
+    parser.add_argument("--budget-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    if args.import_time:
+        sys.exit(0 if check_import_time(HEADLESS_MODULES, args.budget_ms) else 1)
+
+    main(
+        args.transports or list(TRANSPORTS),
+        args.count,
+        args.concurrency,
+        args.latency,
+        args.large_every,
+        max_bytes=args.max_bytes,
+        schedule=args.schedule,
+    )
@@ -0,0 +1,314 @@
+import datetime
+import json
+import os
+
+
+HASH_FILE = "phash.json"
+IMAGE_EXTENSION = ".png"
+
+
+def dhash(path: str, size: int = 8) -> int:
+    """
+    Computes the difference hash of the image at the given path.
+
+    Parameters
+    ----------
+    path : str
+        the path of the image file
+    size : int
+        the width and height of the hash grid, the hash has size * size bits
+
+    Returns
+    -------
+    int
+        the perceptual hash of the image
+    """
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image = image.convert("L").resize((size + 1, size), Image.LANCZOS)
+        pixels = list(image.getdata())
+
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    """
+    Returns the number of differing bits between two hashes.
+    """
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    A BK-tree indexing perceptual hashes by Hamming distance.
+
+    Lookups only descend into children whose edge distance lies within the
+    triangle-inequality bound, so a search touches a small part of the tree
+    instead of comparing against every stored hash.
+
+    Methods
+    -------
+    add(value: int, item):
+        Stores the item under the given hash
+    search(value: int, max_distance: int):
+        Returns (distance, item) pairs for hashes within max_distance
+    """
+
+    def __init__(self) -> None:
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value: int, item):
+        """
+        Stores the item under the given hash.
+
+        Parameters
+        ----------
+        value : int
+            the perceptual hash
+        item : object
+            the item stored with the hash, usually a file path
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+
+        node = self.root
+        while True:
+            node_value, items, children = node
+            distance = hamming(value, node_value)
+            if distance == 0:
+                items.append(item)
+                return
+            child = children.get(distance)
+            if child is None:
+                children[distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int):
+        """
+        Returns (distance, item) pairs for hashes within max_distance.
+
+        Parameters
+        ----------
+        value : int
+            the perceptual hash to look up
+        max_distance : int
+            the largest Hamming distance considered a match
+
+        Returns
+        -------
+        list
+            a list of (distance, item) tuples
+        """
+        if self.root is None:
+            return []
+
+        found = []
+        stack = [self.root]
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                found.extend((distance, item) for item in items)
+            low, high = distance - max_distance, distance + max_distance
+            stack.extend(
+                child for edge, child in children.items() if low <= edge <= high
+            )
+        return found
+
+
+def hash_images(paths: list, workers: int | None = None, executor=None):
+    """
+    Computes perceptual hashes of the given images in a process pool.
+
+    Parameters
+    ----------
+    paths : list
+        a list of image file paths
+    workers : int | None
+        the number of worker processes, defaults to the number of CPUs
+    executor : concurrent.futures.Executor | None
+        a running process pool to reuse, a new one is started if None
+
+    Returns
+    -------
+    dict
+        a dict mapping each readable image path to its hash
+    """
+    hashes = {}
+    if not paths:
+        return hashes
+
+    if executor is None:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return hash_images(paths, workers, executor)
+
+    chunksize = max(1, len(paths) // ((workers or os.cpu_count() or 1) * 4))
+    values = executor.map(_safe_dhash, paths, chunksize=chunksize)
+    for path, value in zip(paths, values):
+        if value is not None:
+            hashes[path] = value
+    return hashes
+
+
+def _safe_dhash(path: str):
+    try:
+        return dhash(path)
+    except Exception:
+        return None
+
+
+def load_hashes(dir_name: str):
+    """
+    Loads the cached hashes of a run directory, keyed by file name.
+    """
+    try:
+        with open(os.path.join(dir_name, HASH_FILE)) as f:
+            return {name: int(value, 16) for name, value in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_hashes(dir_name: str, hashes: dict):
+    """
+    Saves the hashes of a run directory, keyed by file name.
+    """
+    with open(os.path.join(dir_name, HASH_FILE), "w") as f:
+        json.dump({name: format(value, "x") for name, value in hashes.items()}, f)
+
+
+def index_dir(dir_name: str, workers: int | None = None, executor=None):
+    """
+    Returns the hashes of all images in a run directory, keyed by file path.
+
+    Hashes cached in the directory are reused and only new images are hashed.
+    """
+    names = [
+        name for name in os.listdir(dir_name) if name.endswith(IMAGE_EXTENSION)
+    ]
+    cached = load_hashes(dir_name)
+    missing = [os.path.join(dir_name, name) for name in names if name not in cached]
+
+    if missing:
+        for path, value in hash_images(missing, workers, executor).items():
+            cached[os.path.basename(path)] = value
+        try:
+            save_hashes(dir_name, cached)
+        except OSError:
+            pass
+
+    return {
+        os.path.join(dir_name, name): cached[name] for name in names if name in cached
+    }
+
+
+def get_prior_dirs(dir_name: str):
+    """
+    Returns the other run directories next to the given one.
+
+    Run directories are the ones named after a date, as created by
+    ScreenshotDownload.get_dir_name.
+    """
+    parent, current = os.path.split(os.path.normpath(dir_name))
+    prior_dirs = []
+
+    for directory in sorted(os.listdir(parent or os.curdir)):
+        path = os.path.join(parent, directory)
+        if directory == current or not os.path.isdir(path):
+            continue
+        try:
+            datetime.date.fromisoformat(directory[:10])
+        except ValueError:
+            continue
+        prior_dirs.append(path)
+    return prior_dirs
+
+
+def find_duplicates(
+    dir_name: str,
+    max_distance: int = 4,
+    prior: bool = False,
+    workers: int | None = None,
+    executor=None,
+):
+    """
+    Finds clusters of near-identical images in a run directory.
+
+    Parameters
+    ----------
+    dir_name : str
+        the run directory to check
+    max_distance : int
+        the largest Hamming distance between hashes of duplicates
+    prior : bool
+        whether images from prior run directories are matched as well
+    workers : int | None
+        the number of worker processes used for hashing
+    executor : concurrent.futures.Executor | None
+        a running process pool to reuse for hashing
+
+    Returns
+    -------
+    list
+        a list of clusters, each a sorted list of file paths, where every
+        cluster contains at least one image of the given run
+    """
+    current = index_dir(dir_name, workers, executor)
+    hashes = dict(current)
+    if prior:
+        for prior_dir in get_prior_dirs(dir_name):
+            hashes.update(index_dir(prior_dir, workers, executor))
+
+    tree = BKTree()
+    for path, value in hashes.items():
+        tree.add(value, path)
+
+    parents = {}
+
+    def find(path):
+        root = path
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while path != root:
+            parents[path], path = root, parents[path]
+        return root
+
+    for path, value in current.items():
+        for _, match in tree.search(value, max_distance):
+            match_root, path_root = find(match), find(path)
+            if match_root != path_root:
+                parents[match_root] = path_root
+
+    clusters = {}
+    for path in set(parents).union(parents.values()):
+        clusters.setdefault(find(path), []).append(path)
+
+    return sorted(sorted(cluster) for cluster in clusters.values())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Find near-duplicate screenshots")
+    parser.add_argument("dir", help="run directory to check")
+    parser.add_argument("--distance", type=int, default=4)
+    parser.add_argument("--prior", action="store_true", help="match prior runs too")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    for cluster in find_duplicates(args.dir, args.distance, args.prior, args.workers):
+        print(*cluster, sep="\n", end="\n\n")
@@ -110,11 +110,16 @@ class Ui_MainWindow(object):
 
         self.gridLayout.addWidget(self.logs_text, 1, 1, 1, 1)
 
-        self.links_text = QTextEdit(self.text_frame)
+        self.links_text = QPlainTextEdit(self.text_frame)
         self.links_text.setObjectName("links_text")
 
         self.gridLayout.addWidget(self.links_text, 1, 0, 1, 1)
 
+        self.links_count_label = QLabel(self.text_frame)
+        self.links_count_label.setObjectName("links_count_label")
+
+        self.gridLayout.addWidget(self.links_count_label, 2, 0, 1, 1)
+
         self.links_label = QLabel(self.text_frame)
         self.links_label.setObjectName("links_label")
 
@@ -183,15 +188,9 @@ class Ui_MainWindow(object):
         self.load_button.setText(
             QCoreApplication.translate("MainWindow", "Load file", None)
         )
-        self.links_text.setHtml(
+        self.links_text.setPlaceholderText(
             QCoreApplication.translate(
-                "MainWindow",
-                '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.0//EN" "http://www.w3.org/TR/REC-html40/strict.dtd">\n'
-                '<html><head><meta name="qrichtext" content="1" /><style type="text/css">\n'
-                "p, li { white-space: pre-wrap; }\n"
-                "</style></head><body style=\" font-family:'MS Shell Dlg 2'; font-size:7.8pt; font-weight:400; font-style:normal;\">\n"
-                '<p style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;">Links seperated by white spaces</p></body></html>',
-                None,
+                "MainWindow", "Links seperated by white spaces", None
             )
         )
         self.links_label.setText(
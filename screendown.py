@@ -1,14 +1,17 @@
-from bs4 import BeautifulSoup
 from urllib.parse import urlparse
-import requests
+from transport import DEFAULT_CONCURRENCY, PayloadTooLarge, Transport, get_transport
 import os
 import datetime
+import dedup
 
 
 class SSDownloadException(Exception):
     pass
 
 
+SCHEDULES = ("input", "smallest", "largest")
+
+
 class ScreenshotDownload:
     """
     A class used to download screenshots from Lightshot website.
@@ -21,11 +24,29 @@ class ScreenshotDownload:
         a list, tuple or string containing urls to download screenshots from
     dir_name : str
         a string containing the name of the directory where the screenshots will be saved
+    duplicates : bool
+        whether near-duplicate screenshots are reported after the download
+    duplicates_prior : bool
+        whether near-duplicates are also matched against prior run directories
+    transport : transport.Transport
+        the transport used to send requests
+    source_cache : dict | None
+        a mapping of page urls to image sources shared between runs
+    max_bytes : int | None
+        the size above which image transfers are skipped or aborted
+    schedule : str
+        the order of image transfers, one of SCHEDULES
+    hash_executor : concurrent.futures.Executor | None
+        a process pool reused for perceptual hashing
+    saved_urls : dict
+        a dict mapping the path of each image saved by the run to its url
 
     Methods
     -------
     get_dir_name():
         Returns the name of the directory where the screenshots will be saved
+    report(url: str, status: str, message: str):
+        Reports the outcome of processing the given url
     is_valid_url(url: str):
         Returns True if the url is valid, False otherwise
     is_valid_domain(url: str):
@@ -38,13 +59,31 @@ class ScreenshotDownload:
         Fetches the image sources from the given urls and returns them
     save_image(img_title: str, content: bytes):
         Saves the given image content to a file with the given title
+    schedule_transfers(img_sources: list):
+        Returns the indices of the image sources in transfer order
     download_and_save(img_sources: list):
         Downloads and saves the images from the given sources
+    find_duplicates():
+        Finds and reports clusters of near-duplicate saved screenshots
+    make_run_dir():
+        Creates the directory where the screenshots will be saved
     run():
         Runs the screenshot download process
     """
 
-    def __init__(self, urls: list | tuple | str, dir = None) -> None:
+    def __init__(
+        self,
+        urls: list | tuple | str,
+        dir=None,
+        duplicates: bool = False,
+        duplicates_prior: bool = False,
+        transport=None,
+        source_cache: dict | None = None,
+        max_bytes: int | None = None,
+        schedule: str = "input",
+        hash_executor=None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ) -> None:
         """
         Constructs all the necessary attributes for the ScreenshotDownload object.
 
@@ -52,11 +91,47 @@ class ScreenshotDownload:
         ----------
             urls : list | tuple | str
                 a list, tuple or string containing urls to download screenshots from
+            duplicates : bool
+                whether near-duplicate screenshots are reported after the download
+            duplicates_prior : bool
+                whether near-duplicates are also matched against prior runs
+            transport : transport.Transport | str | None
+                a transport or the name of a transport backend, see
+                transport.TRANSPORTS; defaults to the requests backend
+            source_cache : dict | None
+                a mapping of page urls to image sources shared between runs
+            max_bytes : int | None
+                the size above which image transfers are skipped or aborted
+            schedule : str
+                "input" keeps the input order, "smallest" transfers small
+                images first for better tail latency and "largest" transfers
+                large images first to balance bytes between workers; both
+                send a HEAD request per image, concurrency at a time, before
+                the first download starts, and both fall back to the input
+                order when concurrency is 1
+            hash_executor : concurrent.futures.Executor | None
+                a process pool reused for perceptual hashing, a new one is
+                started for each run if None
+            concurrency : int
+                the number of image transfers in flight, used when transport
+                is not a transport instance
         """
+        if schedule not in SCHEDULES:
+            raise ValueError(f"Not valid schedule: {schedule}")
         self.urls = self.format_url(urls)
         self.dir_name = self.get_dir_name(dir)
-
-    def extend_protocol(self, url):
+        self.duplicates = duplicates or duplicates_prior
+        self.duplicates_prior = duplicates_prior
+        self.transport = get_transport(transport, concurrency=concurrency)
+        self.own_transport = not isinstance(transport, Transport)
+        self.source_cache = source_cache
+        self.max_bytes = max_bytes
+        self.schedule = schedule
+        self.hash_executor = hash_executor
+        self.saved_urls = {}
+
+    @staticmethod
+    def extend_protocol(url):
         url = url.strip()
         url = "https://" + url if not url.startswith("http") else url
         return url
@@ -100,10 +175,27 @@ class ScreenshotDownload:
             suffix = max(suffix, int(dir_suffix) + 1)
 
         if suffix == 0:
-            return today_str
+            return os.path.join(dir, today_str)
         return os.path.join(dir, f"{today_str}_{suffix}")
 
-    def is_valid_url(self, url: str):
+    def report(self, url: str, status: str, message: str):
+        """
+        Reports the outcome of processing the given url.
+
+        Parameters
+        ----------
+        url : str
+            the url the outcome refers to
+        status : str
+            one of "invalid", "failed", "parsed", "cached", "saved",
+            "not_saved", "too_large" or "duplicate"
+        message : str
+            a human readable description of the outcome
+        """
+        print(message)
+
+    @staticmethod
+    def is_valid_url(url: str):
         """
         Returns True if the url is valid, False otherwise.
 
@@ -123,7 +215,8 @@ class ScreenshotDownload:
         except:
             return False
 
-    def is_valid_domain(self, url: str):
+    @staticmethod
+    def is_valid_domain(url: str):
         """
         Returns True if the url domain is valid, False otherwise.
 
@@ -154,13 +247,13 @@ class ScreenshotDownload:
 
         Returns
         -------
-        requests.Response
+        requests.Response | transport.Response
             the response from the server
         """
         user_agent = "'Mozilla/5.0 (Windows NT 6.3; WOW64; rv:45.0) Gecko/20100101 Firefox/45.0'"
         headers = {"user-agent": user_agent}
         try:
-            request = requests.get(url, headers=headers)
+            request = self.transport.get(url, headers=headers)
         except Exception as e:
             raise SSDownloadException(e)
         if request.status_code != 200:
@@ -181,6 +274,8 @@ class ScreenshotDownload:
         str
             the image source url
         """
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(request_text, "html.parser")
         tag = soup.find(id="screenshot-image")
         img_source = tag.get("src", None)
@@ -202,15 +297,23 @@ class ScreenshotDownload:
         img_sources = []
         for url in self.urls:
             if not (self.is_valid_url(url) and self.is_valid_domain(url)):
-                print(f"Not valid input: {url}")
+                self.report(url, "invalid", f"Not valid input: {url}")
                 continue
+            if self.source_cache is not None:
+                img_source = self.source_cache.get(url)
+                if img_source is not None:
+                    self.report(url, "cached", f"Image link cached for: {url}")
+                    img_sources.append((img_source, url))
+                    continue
             try:
                 request = self.make_request(url)
                 img_source = self.scrape_image(request.text)
-                print(f"Image link parsed from: {url}")
+                self.report(url, "parsed", f"Image link parsed from: {url}")
             except SSDownloadException as e:
-                print(f"Error with url: {url}; {e}")
+                self.report(url, "failed", f"Error with url: {url}; {e}")
                 continue
+            if self.source_cache is not None:
+                self.source_cache[url] = img_source
             img_sources.append((img_source, url))
 
         return img_sources
@@ -226,44 +329,214 @@ class ScreenshotDownload:
         content : bytes
             the content of the image file
         """
+        path = os.path.join(self.dir_name, f"{img_title}.png")
         try:
-            with open(os.path.join(self.dir_name, f"{img_title}.png"), "wb") as f:
+            with open(path, "wb") as f:
                 f.write(content)
-            print(f"File {url} saved as {img_title}")
+            self.saved_urls[path] = url
+            self.report(url, "saved", f"File {url} saved as {img_title}")
         except Exception as e:
-            print(f"Error while saving to file: {url}")
+            self.report(url, "not_saved", f"Error while saving to file: {url}")
+
+    def schedule_transfers(self, img_sources: list[tuple]):
+        """
+        Returns the indices of the image sources in transfer order.
+
+        With a size-aware schedule, the sizes are looked up with HEAD requests
+        first; sources larger than max_bytes are reported and left out, and
+        sources of unknown size are transferred last. With a single transfer
+        in flight there are no workers to balance, and the HEAD requests
+        would only add a serial round trip per image, so the input order is
+        kept.
+
+        Parameters
+        ----------
+        img_sources : list
+            a list of (image source url, url) tuples
+
+        Returns
+        -------
+        list
+            a list of indices into img_sources
+        """
+        if self.schedule == "input" or self.transport.concurrency == 1:
+            return list(range(len(img_sources)))
+
+        sizes = self.transport.content_lengths([img for img, _ in img_sources])
+        known, unknown = [], []
+        for ind, size in sizes:
+            if not isinstance(size, int):
+                unknown.append(ind)
+            elif self.max_bytes is not None and size > self.max_bytes:
+                url = img_sources[ind][1]
+                self.report(url, "too_large", f"Image too large ({size} B): {url}")
+            else:
+                known.append((size, ind))
+
+        known.sort(reverse=self.schedule == "largest")
+        return [ind for _, ind in known] + sorted(unknown)
 
     def download_and_save(self, img_sources: list[tuple]):
         """
         Downloads and saves the images from the given sources.
 
+        Images are saved as their transfers complete and keep the title of
+        their position in img_sources, whatever order they are transferred in.
+
         Parameters
         ----------
         img_sources : list
-            a list of image source urls
+            a list of (image source url, url) tuples
         """
-        for ind, (img, url) in enumerate(img_sources):
+        order = self.schedule_transfers(img_sources)
+        responses = self.transport.get_many(
+            [img_sources[ind][0] for ind in order], max_bytes=self.max_bytes
+        )
+        for position, request in responses:
+            ind = order[position]
+            url = img_sources[ind][1]
             img_title = f"image_{ind}" if ind else "image"
-            try:
-                request = requests.get(img)
-                if request.status_code != 200:
-                    raise SSDownloadException
-            except:
-                print(f"Can't download image: {url}")
+            if isinstance(request, PayloadTooLarge):
+                self.report(url, "too_large", f"Image too large: {url}; {request}")
+                continue
+            if isinstance(request, Exception) or request.status_code != 200:
+                self.report(url, "failed", f"Can't download image: {url}")
                 continue
 
             self.save_image(img_title, request.content, url)
 
+    def find_duplicates(self, max_distance: int = 4):
+        """
+        Finds and reports clusters of near-duplicate saved screenshots.
+
+        Each cluster is reported under the url of every image of the run in
+        it, with the file paths of the cluster in the message.
+
+        Parameters
+        ----------
+        max_distance : int
+            the largest Hamming distance between perceptual hashes of duplicates
+
+        Returns
+        -------
+        list
+            a list of clusters, each a list of file paths
+        """
+        clusters = dedup.find_duplicates(
+            self.dir_name,
+            max_distance,
+            prior=self.duplicates_prior,
+            executor=self.hash_executor,
+        )
+        for cluster in clusters:
+            message = f"Near-duplicates: {', '.join(cluster)}"
+            for path in cluster:
+                if path in self.saved_urls:
+                    self.report(self.saved_urls[path], "duplicate", message)
+        return clusters
+
+    def make_run_dir(self):
+        """
+        Creates the directory where the screenshots will be saved.
+        """
+        os.mkdir(self.dir_name)
+
     def run(self):
         """
         Runs the screenshot download process.
         """
-        img_sources = self.fetch_image_sources()
+        try:
+            img_sources = self.fetch_image_sources()
 
-        if not img_sources:
-            return
-        os.mkdir(self.dir_name)
-        self.download_and_save(img_sources)
+            if not img_sources:
+                return
+            self.make_run_dir()
+            self.download_and_save(img_sources)
+        finally:
+            if self.own_transport:
+                self.transport.close()
+
+        if self.duplicates:
+            self.find_duplicates()
+
+
+class LinkSet:
+    """
+    An ordered set of urls validated and de-duplicated as they are added.
+
+    ...
+
+    Attributes
+    ----------
+    links : list
+        the valid, unique urls in the order they were added
+    invalid : int
+        the number of rejected urls
+    duplicates : int
+        the number of urls that were already in the set
+
+    Methods
+    -------
+    add(text: str, rejected: list | None):
+        Adds the urls separated by white spaces in text and returns the new ones
+    counts():
+        Returns the numbers of valid, invalid and duplicate urls
+    """
+
+    def __init__(self) -> None:
+        self.links = []
+        self.seen = set()
+        self.invalid = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self.links)
+
+    def add(self, text: str, rejected: list | None = None):
+        """
+        Adds the urls separated by white spaces in text and returns the new ones.
+
+        Parameters
+        ----------
+        text : str
+            a chunk of text, split only at white spaces
+        rejected : list | None
+            a list to append (url, "invalid" or "duplicate") tuples to for
+            each url that was not added
+
+        Returns
+        -------
+        list
+            the urls that were valid and not added before
+        """
+        added = []
+        for url in map(ScreenshotDownload.extend_protocol, text.split()):
+            if url in self.seen:
+                self.duplicates += 1
+                if rejected is not None:
+                    rejected.append((url, "duplicate"))
+            elif not (
+                ScreenshotDownload.is_valid_url(url)
+                and ScreenshotDownload.is_valid_domain(url)
+            ):
+                self.invalid += 1
+                if rejected is not None:
+                    rejected.append((url, "invalid"))
+            else:
+                self.seen.add(url)
+                added.append(url)
+        self.links.extend(added)
+        return added
+
+    def counts(self):
+        """
+        Returns the numbers of valid, invalid and duplicate urls.
+        """
+        return {
+            "valid": len(self.links),
+            "invalid": self.invalid,
+            "duplicate": self.duplicates,
+        }
 
 
 if __name__ == "__main__":
@@ -292,7 +565,7 @@ if __name__ == "__main__":
             urls.extend(url.split())
         return urls
 
-    def main():
+    def main(**options):
         print(
             """Choose option:
     1. From file 
@@ -315,7 +588,43 @@ if __name__ == "__main__":
             if choice.strip() == "0":
                 return
 
-        SD = ScreenshotDownload(urls)
+        SD = ScreenshotDownload(urls, **options)
         SD.run()
 
-    main()
+    import argparse
+    from transport import TRANSPORTS
+
+    parser = argparse.ArgumentParser(description="Lightshot screenshot downloader")
+    parser.add_argument("--transport", choices=TRANSPORTS, default=None)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="number of image transfers in flight, for every transport",
+    )
+    parser.add_argument("--max-bytes", type=int, default=None)
+    parser.add_argument(
+        "--schedule",
+        choices=SCHEDULES,
+        default="input",
+        help="order of image transfers; smallest and largest send a HEAD "
+        "request per image first and need a concurrency above 1",
+    )
+    parser.add_argument(
+        "--dedup", action="store_true", help="report near-duplicate screenshots"
+    )
+    parser.add_argument(
+        "--dedup-prior",
+        action="store_true",
+        help="also match near-duplicates against prior runs",
+    )
+    args = parser.parse_args()
+
+    main(
+        transport=args.transport,
+        concurrency=args.concurrency,
+        max_bytes=args.max_bytes,
+        schedule=args.schedule,
+        duplicates=args.dedup,
+        duplicates_prior=args.dedup_prior,
+    )
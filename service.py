@@ -0,0 +1,459 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from screendown import SCHEDULES, ScreenshotDownload
+import multiprocessing
+import socketserver
+import threading
+import stat
+from transport import DEFAULT_CONCURRENCY, TRANSPORTS, RequestsTransport, get_transport
+import requests
+import json
+import uuid
+import os
+
+
+# Job options in request bodies, mapped to ScreenshotDownload arguments
+JOB_OPTIONS = {
+    "dedup": "duplicates",
+    "dedup_prior": "duplicates_prior",
+    "max_bytes": "max_bytes",
+    "schedule": "schedule",
+}
+FINAL_STATUSES = ("invalid", "failed", "saved", "not_saved", "too_large")
+
+
+class SourceCache:
+    """
+    A thread-safe, size-bounded mapping of page urls to image sources.
+
+    The least recently used entries are evicted once maxsize is reached.
+    """
+
+    def __init__(self, maxsize: int = 100_000) -> None:
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url, default=None):
+        with self.lock:
+            if url not in self.data:
+                return default
+            self.data.move_to_end(url)
+            return self.data[url]
+
+    def __setitem__(self, url, img_source):
+        with self.lock:
+            self.data[url] = img_source
+            self.data.move_to_end(url)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+
+
+class Job:
+    """
+    A batch of urls submitted to the service, with its streamed results.
+
+    Attributes
+    ----------
+    id : str
+        the job id
+    urls : list
+        the urls of the batch
+    status : str
+        one of "queued", "running", "done" or "error"
+    results : list
+        a list of dicts with the url, status and message of each outcome
+    processed : int
+        the number of urls that reached one of FINAL_STATUSES
+    options : dict
+        keyword arguments passed to ScreenshotDownload, e.g. duplicates,
+        max_bytes or schedule
+    """
+
+    def __init__(self, urls: list, dir=None, **options) -> None:
+        self.id = uuid.uuid4().hex
+        self.urls = urls
+        self.dir = dir
+        self.options = options
+        self.status = "queued"
+        self.error = None
+        self.dir_name = None
+        self.results = []
+        self.processed = 0
+        self.condition = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "error")
+
+    def add_result(self, url: str, status: str, message: str):
+        with self.condition:
+            self.results.append({"url": url, "status": status, "message": message})
+            if status in FINAL_STATUSES:
+                self.processed += 1
+            self.condition.notify_all()
+
+    def set_status(self, status: str, error: str | None = None):
+        with self.condition:
+            self.status = status
+            self.error = error
+            self.condition.notify_all()
+
+    def wait_results(self, start: int, timeout: float = 1.0):
+        """
+        Returns the results from index start on, waiting for new ones if needed.
+        """
+        with self.condition:
+            if len(self.results) <= start and not self.finished:
+                self.condition.wait(timeout)
+            return self.results[start:]
+
+    def to_dict(self):
+        with self.condition:
+            return {
+                "id": self.id,
+                "status": self.status,
+                "error": self.error,
+                "dir": self.dir_name,
+                "total": len(self.urls),
+                "processed": self.processed,
+            }
+
+
+class ScreenshotDownloadJob(ScreenshotDownload):
+    """
+    A ScreenshotDownload that reports its outcomes to a Job.
+
+    Directory names are picked and created under a lock shared by all jobs,
+    so concurrent jobs never race for the same run directory.
+    """
+
+    dir_lock = threading.Lock()
+
+    def __init__(self, job: Job, **kwargs) -> None:
+        super().__init__(job.urls, job.dir, **job.options, **kwargs)
+        self.job = job
+
+    def report(self, url: str, status: str, message: str):
+        self.job.add_result(url, status, message)
+
+    def make_run_dir(self):
+        with self.dir_lock:
+            self.dir_name = self.get_dir_name(self.job.dir)
+            os.mkdir(self.dir_name)
+        self.job.dir_name = self.dir_name
+
+
+class Engine:
+    """
+    A long-lived engine that keeps its HTTP pool, caches, job threads and
+    hashing processes warm.
+
+    Methods
+    -------
+    submit(urls: list | str, dir=None, **options):
+        Queues a batch of urls, a list of strings or a string of urls
+        separated by white spaces, and returns its Job
+    get(job_id: str):
+        Returns the job with the given id or None
+    list_jobs():
+        Returns the status of all retained jobs
+    shutdown():
+        Waits for running jobs and releases the engine resources
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_jobs: int = 1000,
+        transport: str | None = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ) -> None:
+        if transport in (None, RequestsTransport.name):
+            # Page requests run on the job threads, image transfers on the
+            # transport threads shared by all jobs.
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=workers, pool_maxsize=workers + concurrency
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.transport = RequestsTransport(session, concurrency)
+        else:
+            self.transport = get_transport(transport, concurrency=concurrency)
+        self.source_cache = SourceCache()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.hash_executor = self.make_hash_executor()
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, urls: list | str, dir=None, **options):
+        """
+        Queues a batch of urls and returns its Job.
+
+        Raises
+        ------
+        ValueError
+            if the given directory or an option is not valid
+        """
+        if dir is not None and not os.path.isdir(dir):
+            raise ValueError("Not valid directory")
+        if not isinstance(options.get("max_bytes", 0), (int, type(None))):
+            raise ValueError(f"Not valid max_bytes: {options['max_bytes']}")
+        if options.get("schedule", "input") not in SCHEDULES:
+            raise ValueError(f"Not valid schedule: {options['schedule']}")
+        if isinstance(urls, str):
+            urls = urls.split()
+        if not isinstance(urls, (list, tuple)) or not all(
+            isinstance(url, str) for url in urls
+        ):
+            raise ValueError("Not valid urls: expected a list of strings")
+        job = Job(list(urls), dir, **options)
+
+        with self.lock:
+            self.jobs[job.id] = job
+            self.prune()
+        self.executor.submit(self.run_job, job)
+        return job
+
+    @staticmethod
+    def make_hash_executor():
+        # Worker processes are started on the first dedup job and kept. They
+        # are spawned rather than forked, as forking the threads of a running
+        # engine can deadlock the child.
+        return ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+
+    def replace_hash_executor(self, executor):
+        """
+        Replaces the given broken process pool, unless another job already did.
+        """
+        with self.lock:
+            if self.hash_executor is not executor:
+                return
+            self.hash_executor = self.make_hash_executor()
+        executor.shutdown(wait=False)
+
+    def prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def run_job(self, job: Job):
+        job.set_status("running")
+        hash_executor = self.hash_executor
+        try:
+            ScreenshotDownloadJob(
+                job,
+                transport=self.transport,
+                source_cache=self.source_cache,
+                hash_executor=hash_executor,
+            ).run()
+        except BrokenProcessPool as e:
+            # A hashing process died, e.g. killed on a huge image; later jobs
+            # get a new pool.
+            self.replace_hash_executor(hash_executor)
+            job.set_status("error", f"Hashing processes failed: {e}")
+            return
+        except Exception as e:
+            job.set_status("error", str(e))
+            return
+        job.set_status("done")
+
+    def get(self, job_id: str):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.hash_executor.shutdown(wait=True)
+        self.transport.close()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the job API of the engine attached to the server.
+
+    POST /jobs                 queues a batch, the body is a JSON object with
+                               "urls" and optional "dir", "dedup",
+                               "max_bytes" and "schedule" keys, or plain text
+                               urls separated by white spaces
+    GET  /jobs                 lists all jobs
+    GET  /jobs/<id>            returns the status of a job
+    GET  /jobs/<id>/results    streams the results as JSON lines until the
+                               job is finished
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_json(self, code: int, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": "Not found"})
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError(f"Not valid Content-Length: {length}")
+            body = self.rfile.read(length).decode()
+            if self.headers.get_content_type() == "application/json":
+                data = json.loads(body)
+            else:
+                data = {"urls": body}
+            options = {
+                argument: data[key]
+                for key, argument in JOB_OPTIONS.items()
+                if key in data
+            }
+            job = self.server.engine.submit(data["urls"], data.get("dir"), **options)
+        except (ValueError, KeyError, TypeError) as e:
+            # The body may be left unread, so the connection can't be reused.
+            self.close_connection = True
+            return self.send_json(400, {"error": str(e)})
+        self.send_json(202, job.to_dict())
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            return self.send_json(200, self.server.engine.list_jobs())
+        if len(parts) not in (2, 3) or parts[0] != "jobs":
+            return self.send_json(404, {"error": "Not found"})
+
+        job = self.server.engine.get(parts[1])
+        if job is None:
+            return self.send_json(404, {"error": "No such job"})
+        if len(parts) == 2:
+            return self.send_json(200, job.to_dict())
+        if parts[2] != "results":
+            return self.send_json(404, {"error": "Not found"})
+        self.stream_results(job)
+
+    def stream_results(self, job: Job):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        sent = 0
+        while True:
+            finished = job.finished
+            results = job.wait_results(sent)
+            if results:
+                sent += len(results)
+                self.send_chunk(
+                    "".join(json.dumps(result) + "\n" for result in results).encode()
+                )
+            elif finished:
+                break
+        self.send_chunk(json.dumps(job.to_dict()).encode() + b"\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    socket_path: str | None = None,
+    workers: int = 4,
+    transport: str | None = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+):
+    """
+    Runs the job API until interrupted.
+
+    Parameters
+    ----------
+    host : str
+        the address to listen on
+    port : int
+        the TCP port to listen on
+    socket_path : str | None
+        a Unix socket path to listen on instead of host and port
+    workers : int
+        the number of jobs processed at the same time
+    transport : str | None
+        the name of the transport backend, see transport.TRANSPORTS
+    concurrency : int
+        the number of image transfers in flight, shared by all jobs
+
+    Raises
+    ------
+    FileExistsError
+        if socket_path exists and is not a socket; a stale socket is replaced
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise FileExistsError(f"Not a socket: {socket_path}")
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.engine = Engine(workers, transport=transport, concurrency=concurrency)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.engine.shutdown()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Screenshot download service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="listen on a Unix socket")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--transport", choices=TRANSPORTS, default=None)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="number of image transfers in flight, for every transport",
+    )
+    args = parser.parse_args()
+
+    try:
+        serve(
+            args.host,
+            args.port,
+            args.socket,
+            args.workers,
+            args.transport,
+            args.concurrency,
+        )
+    except FileExistsError as e:
+        parser.error(str(e))
@@ -1,6 +1,15 @@
 import unittest
 import screendown
+import dedup
+import service
+import transport
+import bench
 import os
+import tempfile
+import threading
+import time
+import http.client
+import json
 from unittest.mock import patch, Mock, mock_open
 from screendown import ScreenshotDownload as SSD
 from freezegun import freeze_time
@@ -21,14 +30,14 @@ class TestScreenshotDownload(unittest.TestCase):
     def test_get_dir_name_no_same_date(self, mock_oslistdir):
         mock_oslistdir.return_value = ['2022-10-14']
         obj = SSD(['https://example.com/', 'https://another-example.com/'])
-        self.assertEqual(obj.get_dir_name(), '2023-10-14')
+        self.assertEqual(obj.get_dir_name(), os.path.join(os.getcwd(), '2023-10-14'))
     
     @freeze_time('2023-10-14')
     @patch('screendown.os.listdir')
     def test_get_dir_name_single_same_date(self, mock_oslistdir):
         mock_oslistdir.return_value = ['2023-10-14']
         obj = SSD(['https://example.com/', 'https://another-example.com/'])
-        self.assertEqual(obj.get_dir_name(), '2023-10-14_1')
+        self.assertEqual(obj.get_dir_name(), os.path.join(os.getcwd(), '2023-10-14_1'))
         
     @freeze_time('2023-10-14')
     @patch('screendown.os.listdir')
@@ -40,9 +49,9 @@ class TestScreenshotDownload(unittest.TestCase):
             '2023-10-14_xyz'
             ]
         obj = SSD(['https://example.com/', 'https://another-example.com/'])
-        self.assertEqual(obj.get_dir_name(), '2023-10-14_4')
+        self.assertEqual(obj.get_dir_name(), os.path.join(os.getcwd(), '2023-10-14_4'))
     
-    @patch('screendown.requests.get')
+    @patch('requests.Session.get')
     def test_make_request_valid(self, mock_get):
         text = "<html><img id='screenshot-image', src='fake_image.png'></html>"
         mock_response = Mock(status_code = 200, text=text) 
@@ -53,7 +62,7 @@ class TestScreenshotDownload(unittest.TestCase):
         
         self.assertEqual(request, mock_response)
         
-    @patch('screendown.requests.get')
+    @patch('requests.Session.get')
     def test_make_request_error(self, mock_get):
         text = "<html><img id='screenshot-image', src='fake_image.png'></html>"
         mock_response = Mock(status_code = 400, text=text) 
@@ -105,7 +114,7 @@ class TestScreenshotDownload(unittest.TestCase):
             m_open.assert_called_once_with(os.path.join(obj.dir_name, f'{img_title}.png'), 'wb')
             m_open().write.assert_called_once_with(img_content)
 
-    @patch('screendown.requests.get')
+    @patch('requests.Session.get')
     def test_download_and_save(self, mock_get):
         obj = SSD(['https://example.com/', 'https://another-example.com/'])
         img_sources = ['fake_image.png', 'fake_image_1.png']
@@ -137,6 +146,425 @@ class TestScreenshotDownload(unittest.TestCase):
         obj.run()
 
         mock_mkdir.assert_called_once_with(obj.dir_name)
-        
+
+
+class TestLinkSet(unittest.TestCase):
+
+    def test_add_validates_and_deduplicates(self):
+        links = screendown.LinkSet()
+        added = links.add('prnt.sc/abc https://prnt.sc/abc\nexample.com/abc prnt.sc/def')
+        self.assertEqual(added, ['https://prnt.sc/abc', 'https://prnt.sc/def'])
+        self.assertEqual(links.counts(), {'valid': 2, 'invalid': 1, 'duplicate': 1})
+
+    def test_add_across_chunks(self):
+        links = screendown.LinkSet()
+        links.add('prnt.sc/abc\n')
+        added = links.add('prnt.sc/abc\nprnt.sc/def\n')
+        self.assertEqual(added, ['https://prnt.sc/def'])
+        self.assertEqual(links.links, ['https://prnt.sc/abc', 'https://prnt.sc/def'])
+        self.assertEqual(len(links), 2)
+
+    def test_add_collects_rejected(self):
+        links = screendown.LinkSet()
+        rejected = []
+        links.add('prnt.sc/abc example.com/abc prnt.sc/abc', rejected)
+        self.assertEqual(rejected, [
+            ('https://example.com/abc', 'invalid'),
+            ('https://prnt.sc/abc', 'duplicate'),
+        ])
+
+
+class TestDuplicates(unittest.TestCase):
+
+    def test_bktree_search_within_distance(self):
+        tree = dedup.BKTree()
+        tree.add(0b0000, 'a')
+        tree.add(0b0001, 'b')
+        tree.add(0b0111, 'c')
+        tree.add(0b0000, 'd')
+        found = sorted(item for _, item in tree.search(0b0000, 1))
+        self.assertEqual(found, ['a', 'b', 'd'])
+        self.assertEqual(len(tree), 4)
+
+    def test_bktree_search_empty(self):
+        self.assertEqual(dedup.BKTree().search(0, 4), [])
+
+    @patch('dedup.index_dir')
+    def test_find_duplicates_clusters(self, mock_index_dir):
+        mock_index_dir.return_value = {
+            'image': 0b0000,
+            'image_1': 0b0001,
+            'image_2': 0b0011,
+            'image_3': 0b1111_0000,
+        }
+        clusters = dedup.find_duplicates('path', max_distance=1)
+        self.assertEqual(clusters, [['image', 'image_1', 'image_2']])
+
+    def test_hash_images_reuses_executor(self):
+        executor = Mock()
+        executor.map.return_value = [1, None]
+        hashes = dedup.hash_images(['a.png', 'b.png'], executor=executor)
+        self.assertEqual(hashes, {'a.png': 1})
+        executor.shutdown.assert_not_called()
+
+    @patch('dedup.get_prior_dirs')
+    @patch('dedup.index_dir')
+    def test_find_duplicates_prior(self, mock_index_dir, mock_get_prior_dirs):
+        mock_get_prior_dirs.return_value = ['prior']
+        mock_index_dir.side_effect = [
+            {'image': 0b0000},
+            {'prior/image': 0b0001, 'prior/image_1': 0b0011},
+        ]
+        clusters = dedup.find_duplicates('path', max_distance=1, prior=True)
+        self.assertEqual(clusters, [['image', 'prior/image']])
+
+    @patch('dedup.find_duplicates')
+    def test_duplicates_reported_by_url(self, mock_find_duplicates):
+        obj = SSD(['https://prnt.sc/abc'])
+        obj.dir_name = 'path'
+        obj.report = Mock()
+        obj.saved_urls = {
+            os.path.join('path', 'image.png'): 'https://prnt.sc/abc',
+            os.path.join('path', 'image_1.png'): 'https://prnt.sc/def',
+        }
+        cluster = [os.path.join('path', 'image.png'), os.path.join('prior', 'image.png')]
+        mock_find_duplicates.return_value = [cluster]
+        obj.find_duplicates()
+        obj.report.assert_called_once_with(
+            'https://prnt.sc/abc', 'duplicate', f"Near-duplicates: {', '.join(cluster)}"
+        )
+
+
+class TestService(unittest.TestCase):
+
+    def test_source_cache_evicts_least_recently_used(self):
+        cache = service.SourceCache(maxsize=2)
+        cache['a'] = 'a.png'
+        cache['b'] = 'b.png'
+        cache.get('a')
+        cache['c'] = 'c.png'
+        self.assertEqual(cache.get('a'), 'a.png')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_fetch_image_sources_uses_source_cache(self):
+        obj = SSD(['https://prnt.sc/abc'], source_cache={'https://prnt.sc/abc': 'fake_image.png'})
+        obj.make_request = Mock()
+        obj.report = Mock()
+        img_sources = obj.fetch_image_sources()
+        obj.make_request.assert_not_called()
+        self.assertEqual(obj.report.call_args[0][:2], ('https://prnt.sc/abc', 'cached'))
+        self.assertEqual(img_sources, [('fake_image.png', 'https://prnt.sc/abc')])
+
+    def test_job_reports_results(self):
+        job = service.Job(['https://example.com/'])
+        obj = service.ScreenshotDownloadJob(job)
+        obj.fetch_image_sources()
+        job.set_status('done')
+        self.assertEqual(job.wait_results(0)[0]['status'], 'invalid')
+        self.assertEqual(job.to_dict()['processed'], 1)
+
+    def test_job_processed_counts_urls(self):
+        job = service.Job(['https://prnt.sc/abc', 'https://prnt.sc/def'])
+        job.add_result('https://prnt.sc/abc', 'parsed', '')
+        job.add_result('https://prnt.sc/def', 'cached', '')
+        job.add_result('https://prnt.sc/abc', 'saved', '')
+        self.assertEqual(job.to_dict()['processed'], 1)
+        job.add_result('https://prnt.sc/def', 'too_large', '')
+        self.assertEqual(job.to_dict()['processed'], 2)
+
+    def test_job_maps_dedup_option(self):
+        job = service.Job(['https://prnt.sc/abc'], duplicates=True)
+        obj = service.ScreenshotDownloadJob(job)
+        self.assertTrue(obj.duplicates)
+        self.assertFalse(obj.duplicates_prior)
+
+    def test_engine_rejects_invalid_directory(self):
+        engine = service.Engine(workers=1)
+        with self.assertRaises(ValueError):
+            engine.submit(['https://prnt.sc/abc'], dir='/not/a/directory')
+        engine.shutdown()
+
+    @patch('service.ScreenshotDownloadJob.download_and_save')
+    @patch('service.ScreenshotDownloadJob.fetch_image_sources')
+    def test_jobs_share_directory(self, mock_fetch, mock_download):
+        mock_fetch.return_value = [('fake_image.png', 'https://prnt.sc/abc')]
+        engine = service.Engine(workers=2)
+        with tempfile.TemporaryDirectory() as dir:
+            jobs = [engine.submit(['https://prnt.sc/abc'], dir=dir) for _ in range(2)]
+            engine.shutdown()
+            self.assertEqual([job.status for job in jobs], ['done', 'done'])
+            dir_names = {job.dir_name for job in jobs}
+            self.assertEqual(len(dir_names), 2)
+            for dir_name in dir_names:
+                self.assertEqual(os.path.dirname(dir_name), dir)
+                self.assertTrue(os.path.isdir(dir_name))
+
+    def test_engine_passes_concurrency(self):
+        for name in transport.TRANSPORTS:
+            with self.subTest(transport=name):
+                engine = service.Engine(workers=1, transport=name, concurrency=3)
+                self.assertEqual(engine.transport.concurrency, 3)
+                engine.shutdown()
+
+    @patch('service.ScreenshotDownloadJob.run')
+    def test_engine_replaces_broken_hash_executor(self, mock_run):
+        mock_run.side_effect = service.BrokenProcessPool('worker died')
+        engine = service.Engine(workers=1)
+        broken = engine.hash_executor
+        job = engine.submit(['https://prnt.sc/abc'], duplicates=True)
+        engine.executor.shutdown(wait=True)
+        self.assertEqual(job.status, 'error')
+        self.assertIsNot(engine.hash_executor, broken)
+        engine.shutdown()
+
+    def post_jobs(self, body: bytes, headers: dict):
+        server = service.ThreadingHTTPServer(('127.0.0.1', 0), service.RequestHandler)
+        server.engine = service.Engine(workers=1)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+            connection.putrequest('POST', '/jobs')
+            for name, value in headers.items():
+                connection.putheader(name, value)
+            connection.endheaders(body)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+            server.engine.shutdown()
+
+    def test_post_rejects_negative_content_length(self):
+        status, data = self.post_jobs(b'prnt.sc/abc', {'Content-Length': '-1'})
+        self.assertEqual(status, 400)
+        self.assertIn('Content-Length', data['error'])
+
+    def test_post_rejects_urls_not_strings(self):
+        body = json.dumps({'urls': [1, 2]}).encode()
+        status, data = self.post_jobs(body, {
+            'Content-Type': 'application/json',
+            'Content-Length': str(len(body)),
+        })
+        self.assertEqual(status, 400)
+        self.assertIn('urls', data['error'])
+
+    def test_serve_keeps_regular_file_at_socket_path(self):
+        with tempfile.NamedTemporaryFile() as f:
+            with self.assertRaises(FileExistsError):
+                service.serve(socket_path=f.name)
+            self.assertTrue(os.path.isfile(f.name))
+
+
+class TestTransport(unittest.TestCase):
+
+    def test_get_transport_default(self):
+        self.assertIsInstance(transport.get_transport(), transport.RequestsTransport)
+
+    def test_get_transport_instance(self):
+        obj = transport.RequestsTransport()
+        self.assertIs(transport.get_transport(obj), obj)
+
+    def test_concurrency_default_for_every_transport(self):
+        for name in transport.TRANSPORTS:
+            with self.subTest(transport=name):
+                obj = SSD(['https://prnt.sc/abc'], transport=name)
+                self.assertEqual(obj.transport.concurrency, transport.DEFAULT_CONCURRENCY)
+
+    def test_get_transport_unknown(self):
+        with self.assertRaises(ValueError):
+            transport.get_transport('carrier-pigeon')
+
+    @patch('requests.Session.get')
+    def test_get_many_yields_indices(self, mock_get):
+        mock_get.side_effect = lambda url, headers=None: Mock(status_code=200, url=url)
+        urls = [f'https://example.com/{ind}' for ind in range(10)]
+        with transport.RequestsTransport(concurrency=4) as obj:
+            responses = dict(obj.get_many(urls))
+        self.assertEqual([responses[ind].url for ind in range(10)], urls)
+
+    @patch('requests.Session.get')
+    def test_get_many_yields_exceptions(self, mock_get):
+        error = ConnectionError()
+        mock_get.side_effect = [error, Mock(status_code=200)]
+        obj = transport.RequestsTransport()
+        responses = dict(obj.get_many(['https://example.com/', 'https://another-example.com/']))
+        self.assertIs(responses[0], error)
+        self.assertEqual(responses[1].status_code, 200)
+
+    @patch('requests.Session.get')
+    def test_get_many_slow_request_blocks_one_worker(self, mock_get):
+        def get(url, headers=None):
+            time.sleep(0.5 if url.endswith('/0') else 0.05)
+            return Mock(status_code=200, url=url)
+
+        mock_get.side_effect = get
+        urls = [f'https://example.com/{ind}' for ind in range(40)]
+        start = time.perf_counter()
+        with transport.RequestsTransport(concurrency=4) as obj:
+            order = [ind for ind, _ in obj.get_many(urls)]
+        elapsed = time.perf_counter() - start
+        # Three workers share the 39 fast requests while one waits for the
+        # slow one, about 0.65 seconds. Waiting for the oldest request
+        # instead takes about 0.95 seconds.
+        self.assertLess(elapsed, 0.8)
+        self.assertEqual(sorted(order), list(range(40)))
+        self.assertGreater(order.index(0), 3)
+
+    def test_http2_prior_knowledge(self):
+        with bench.h2_stand_in_server(latency=0) as (host, port):
+            with transport.HttpxTransport(http1=False) as obj:
+                response = obj.get(f'http://{host}:{port}/abc')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.http_version, 'HTTP/2')
+        self.assertIn(f'http://{host}:{port}/img/abc', response.text)
+
+    def test_http2_max_bytes_keeps_connection_usable(self):
+        # Ten aborted 2 MB images outgrow the 16 MiB connection window httpx
+        # opens, unless the aborted bodies are credited.
+        with bench.h2_stand_in_server(latency=0, bandwidth=1e10, image_size=2_000_000) as (host, port):
+            with transport.HttpxTransport(http1=False) as obj:
+                for ind in range(10):
+                    with self.assertRaises(transport.PayloadTooLarge):
+                        obj.get(f'http://{host}:{port}/img/{ind}', max_bytes=1000)
+                response = obj.get(f'http://{host}:{port}/abc')
+        self.assertEqual(response.status_code, 200)
+
+    def test_response_text(self):
+        response = transport.Response(200, 'zdjęcie'.encode())
+        self.assertEqual(response.text, 'zdjęcie')
+
+
+class TestScheduling(unittest.TestCase):
+
+    img_sources = [
+        ('a.png', 'https://prnt.sc/a'),
+        ('b.png', 'https://prnt.sc/b'),
+        ('c.png', 'https://prnt.sc/c'),
+        ('d.png', 'https://prnt.sc/d'),
+    ]
+
+    def make_obj(self, **kwargs):
+        obj = SSD(['https://prnt.sc/a'], **kwargs)
+        obj.transport.content_lengths = Mock(return_value=enumerate([300, None, 100, 200]))
+        obj.report = Mock()
+        return obj
+
+    def test_schedule_input(self):
+        obj = self.make_obj()
+        self.assertEqual(obj.schedule_transfers(self.img_sources), [0, 1, 2, 3])
+        obj.transport.content_lengths.assert_not_called()
+
+    def test_schedule_smallest(self):
+        obj = self.make_obj(schedule='smallest')
+        self.assertEqual(obj.schedule_transfers(self.img_sources), [2, 3, 0, 1])
+
+    def test_schedule_largest(self):
+        obj = self.make_obj(schedule='largest')
+        self.assertEqual(obj.schedule_transfers(self.img_sources), [0, 3, 2, 1])
+
+    def test_schedule_skips_too_large(self):
+        obj = self.make_obj(schedule='smallest', max_bytes=250)
+        self.assertEqual(obj.schedule_transfers(self.img_sources), [2, 3, 1])
+        obj.report.assert_called_once()
+        self.assertEqual(obj.report.call_args[0][:2], ('https://prnt.sc/a', 'too_large'))
+
+    def test_schedule_kept_with_one_worker(self):
+        obj = self.make_obj(schedule='largest', concurrency=1)
+        self.assertEqual(obj.schedule_transfers(self.img_sources), [0, 1, 2, 3])
+        obj.transport.content_lengths.assert_not_called()
+
+    def test_schedule_not_valid(self):
+        with self.assertRaises(ValueError):
+            SSD(['https://prnt.sc/a'], schedule='random')
+
+    def test_download_and_save_keeps_titles(self):
+        obj = self.make_obj(schedule='smallest')
+        obj.save_image = Mock()
+        obj.transport.get_many = Mock(side_effect=lambda urls, max_bytes=None: reversed([
+            (ind, Mock(status_code=200, content=url.encode())) for ind, url in enumerate(urls)
+        ]))
+        obj.download_and_save(self.img_sources)
+        self.assertEqual(obj.save_image.call_args_list[3][0], ('image_2', b'c.png', 'https://prnt.sc/c'))
+        self.assertEqual(obj.save_image.call_args_list[1][0], ('image', b'a.png', 'https://prnt.sc/a'))
+
+    @patch('requests.Session.head')
+    @patch('requests.Session.get')
+    def run_schedule(self, schedule, sizes, concurrency, mock_get, mock_head):
+        # Each transfer takes one millisecond per byte.
+        img_sources = [
+            (f'https://img.example.com/{size}/{ind}', f'https://prnt.sc/{ind}')
+            for ind, size in enumerate(sizes)
+        ]
+
+        def get(url, headers=None):
+            time.sleep(int(url.split('/')[-2]) / 1000)
+            return Mock(status_code=200, content=b'')
+
+        mock_get.side_effect = get
+        mock_head.side_effect = lambda url, headers=None, allow_redirects=True: Mock(
+            ok=True, headers={'content-length': url.split('/')[-2]}
+        )
+        obj = SSD(['https://prnt.sc/a'], schedule=schedule,
+                  transport=transport.RequestsTransport(concurrency=concurrency))
+        obj.save_image = Mock()
+        start = time.perf_counter()
+        obj.download_and_save(img_sources)
+        elapsed = time.perf_counter() - start
+        obj.transport.close()
+        return elapsed, [call[0][0] for call in obj.save_image.call_args_list]
+
+    def test_schedule_largest_balances_workers(self):
+        # Three workers share twelve small images and a large one. Started
+        # first, the large image takes 0.4 seconds while the other two
+        # workers share the small ones; started last, it runs after 0.2
+        # seconds of small transfers.
+        sizes = [50] * 12 + [400]
+        input_elapsed, _ = self.run_schedule('input', sizes, 3)
+        largest_elapsed, saved = self.run_schedule('largest', sizes, 3)
+        self.assertGreaterEqual(input_elapsed, 0.6)
+        self.assertLess(largest_elapsed, 0.55)
+        self.assertEqual(len(saved), 13)
+
+    def test_schedule_smallest_saves_small_images_first(self):
+        sizes = [400, 400, 50, 50, 50, 50]
+        _, saved = self.run_schedule('input', sizes, 2)
+        self.assertEqual(sorted(saved[:2]), ['image', 'image_1'])
+        _, saved = self.run_schedule('smallest', sizes, 2)
+        self.assertEqual(sorted(saved[-2:]), ['image', 'image_1'])
+
+    @patch('requests.Session.get')
+    def test_max_bytes_from_content_length(self, mock_get):
+        response = Mock(status_code=200, headers={'content-length': '1000'})
+        response.__enter__ = Mock(return_value=response)
+        response.__exit__ = Mock(return_value=False)
+        mock_get.return_value = response
+        with self.assertRaises(transport.PayloadTooLarge):
+            transport.RequestsTransport().get('https://example.com/', max_bytes=100)
+        response.iter_content.assert_not_called()
+
+    @patch('requests.Session.get')
+    def test_max_bytes_while_reading(self, mock_get):
+        response = Mock(status_code=200, headers={})
+        response.__enter__ = Mock(return_value=response)
+        response.__exit__ = Mock(return_value=False)
+        response.iter_content.return_value = iter([b'x' * 60, b'x' * 60, b'x' * 60])
+        mock_get.return_value = response
+        with self.assertRaises(transport.PayloadTooLarge):
+            transport.RequestsTransport().get('https://example.com/', max_bytes=100)
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_headless_modules_skip_heavy_imports(self):
+        for module in bench.HEADLESS_MODULES:
+            with self.subTest(module=module):
+                imported = bench.import_times(module)
+                self.assertIn(module, imported)
+                for name in bench.HEAVY_IMPORTS:
+                    self.assertNotIn(name, imported)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,437 @@
+import itertools
+import threading
+
+
+# The number of requests in flight used by the command line and the service,
+# whatever the backend
+DEFAULT_CONCURRENCY = 16
+
+
+class Response:
+    """
+    A minimal response returned by transports whose client has no
+    requests-compatible response object.
+
+    Attributes
+    ----------
+    status_code : int
+        the HTTP status code
+    content : bytes
+        the response body
+    headers : dict
+        the response headers
+    """
+
+    def __init__(
+        self, status_code: int, content: bytes, headers=None, encoding=None
+    ) -> None:
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+def content_length(headers):
+    """
+    Returns the Content-Length of the given headers as int, or None.
+    """
+    try:
+        return int(headers.get("content-length"))
+    except (TypeError, ValueError):
+        return None
+
+
+def check_size(size: int | None, max_bytes: int | None):
+    """
+    Raises PayloadTooLarge if size exceeds max_bytes.
+    """
+    if max_bytes is not None and size is not None and size > max_bytes:
+        raise PayloadTooLarge(f"Payload of {size} bytes exceeds {max_bytes} bytes")
+
+
+class Transport:
+    """
+    The interface ScreenshotDownload uses to talk to the network.
+
+    Methods
+    -------
+    get(url: str, headers: dict | None, max_bytes: int | None):
+        Sends a GET request and returns the response
+    head(url: str, headers: dict | None):
+        Sends a HEAD request and returns the Content-Length or None
+    get_many(urls: list, headers: dict | None, max_bytes: int | None):
+        Yields (index, response or exception) pairs as requests complete
+    content_lengths(urls: list, headers: dict | None):
+        Yields (index, size) pairs as requests complete, where size is the
+        Content-Length, None or an exception
+    close():
+        Releases the connections held by the transport
+    """
+
+    name = None
+
+    def __init__(self, concurrency: int = 1) -> None:
+        self.concurrency = max(1, concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, url: str, headers: dict | None = None, max_bytes: int | None = None):
+        """
+        Sends a GET request and returns the response.
+
+        Raises
+        ------
+        PayloadTooLarge
+            if max_bytes is given and the body is larger, the transfer is
+            aborted as soon as the Content-Length or the bytes read exceed it
+        """
+        raise NotImplementedError
+
+    def head(self, url: str, headers: dict | None = None):
+        raise NotImplementedError
+
+    def submit(self, call, *args):
+        """
+        Starts call(*args) and returns a future of its result.
+        """
+        raise NotImplementedError
+
+    def get_many(
+        self, urls: list, headers: dict | None = None, max_bytes: int | None = None
+    ):
+        """
+        Yields (index, response or exception) pairs as requests complete.
+
+        The index is the position of the url in urls. See map for how
+        requests are scheduled.
+        """
+        return self.map(self.get, urls, headers, max_bytes)
+
+    def content_lengths(self, urls: list, headers: dict | None = None):
+        """
+        Yields (index, size) pairs as requests complete, where size is the
+        Content-Length, None or an exception.
+        """
+        return self.map(self.head, urls, headers)
+
+    def map(self, call, urls: list, *args):
+        """
+        Yields (index, result or exception) pairs of call(url, *args) for
+        each url, in the order the calls complete.
+
+        Up to concurrency calls are in flight, and a new one starts as soon
+        as any of them completes, so a slow transfer holds up one worker
+        instead of the whole batch. Results are not held back for ordering,
+        so a large batch is never held in memory at once.
+        """
+        if self.concurrency == 1:
+            for ind, url in enumerate(urls):
+                try:
+                    yield ind, call(url, *args)
+                except Exception as e:
+                    yield ind, e
+            return
+
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        urls = enumerate(urls)
+        pending = {}
+        while True:
+            for ind, url in itertools.islice(urls, self.concurrency - len(pending)):
+                pending[self.submit(call, url, *args)] = ind
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), self.result(future)
+
+    @staticmethod
+    def result(future):
+        try:
+            return future.result()
+        except Exception as e:
+            return e
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    """
+    A transport using a requests.Session, with a thread pool for get_many.
+    """
+
+    name = "requests"
+
+    def __init__(self, session=None, concurrency: int = 1) -> None:
+        super().__init__(concurrency)
+        if session is None:
+            import requests
+
+            session = requests.Session()
+        self.session = session
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get(self, url: str, headers: dict | None = None, max_bytes: int | None = None):
+        if max_bytes is None:
+            return self.session.get(url, headers=headers)
+
+        with self.session.get(url, headers=headers, stream=True) as response:
+            check_size(content_length(response.headers), max_bytes)
+            chunks, size = [], 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                check_size(size, max_bytes)
+                chunks.append(chunk)
+            return Response(
+                response.status_code,
+                b"".join(chunks),
+                response.headers,
+                response.encoding,
+            )
+
+    def head(self, url: str, headers: dict | None = None):
+        response = self.session.head(url, headers=headers, allow_redirects=True)
+        return content_length(response.headers) if response.ok else None
+
+    def submit(self, call, *args):
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return self.executor.submit(call, *args)
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+        self.session.close()
+
+
+def run_threadsafe(coroutine, loop):
+    """
+    Schedules the coroutine on the loop running in another thread.
+    """
+    import asyncio
+
+    return asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+
+class AsyncTransport(Transport):
+    """
+    A base for transports built on an asyncio client.
+
+    The client lives on an event loop running in a background thread, so it
+    keeps its connections between calls and can serve callers from any thread.
+    The loop and the client are started on first use and again after close().
+    Subclasses implement the fetch and fetch_head coroutines.
+    """
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY) -> None:
+        super().__init__(concurrency)
+        self.loop = None
+        self.thread = None
+        self.client = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        import asyncio
+
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(
+                    target=self.loop.run_forever, daemon=True
+                )
+                self.thread.start()
+            return self.loop
+
+    def submit(self, call, *args):
+        coroutine = {self.get: self.fetch, self.head: self.fetch_head}[call]
+        return run_threadsafe(coroutine(*args), self.start())
+
+    def get(self, url: str, headers: dict | None = None, max_bytes: int | None = None):
+        return self.submit(self.get, url, headers, max_bytes).result()
+
+    def head(self, url: str, headers: dict | None = None):
+        return self.submit(self.head, url, headers).result()
+
+    async def fetch(
+        self, url: str, headers: dict | None = None, max_bytes: int | None = None
+    ):
+        raise NotImplementedError
+
+    async def fetch_head(self, url: str, headers: dict | None = None):
+        raise NotImplementedError
+
+    async def close_client(self):
+        raise NotImplementedError
+
+    def close(self):
+        with self.lock:
+            loop, thread, self.loop, self.thread = self.loop, self.thread, None, None
+        if loop is None:
+            return
+        if self.client is not None:
+            run_threadsafe(self.close_client(), loop).result()
+            self.client = None
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+class AiohttpTransport(AsyncTransport):
+    """
+    An asyncio transport using an aiohttp.ClientSession.
+    """
+
+    name = "asyncio"
+
+    def get_client(self):
+        import aiohttp
+
+        if self.client is None:
+            self.client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency)
+            )
+        return self.client
+
+    async def fetch(
+        self, url: str, headers: dict | None = None, max_bytes: int | None = None
+    ):
+        async with self.get_client().get(url, headers=headers) as response:
+            check_size(response.content_length, max_bytes)
+            chunks, size = [], 0
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                check_size(size, max_bytes)
+                chunks.append(chunk)
+            return Response(
+                response.status, b"".join(chunks), response.headers, response.charset
+            )
+
+    async def fetch_head(self, url: str, headers: dict | None = None):
+        async with self.get_client().head(
+            url, headers=headers, allow_redirects=True
+        ) as response:
+            return content_length(response.headers) if response.ok else None
+
+    async def close_client(self):
+        await self.client.close()
+
+
+class HttpxTransport(AsyncTransport):
+    """
+    An asyncio transport using an httpx.AsyncClient with HTTP/2 enabled.
+
+    Requests to the same host are multiplexed over one connection when the
+    server negotiates HTTP/2, otherwise the client falls back to HTTP/1.1.
+    With http1 False, HTTP/1.1 is not offered and plain http:// urls are
+    sent as HTTP/2 with prior knowledge, for servers speaking h2c.
+    """
+
+    name = "http2"
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, http1: bool = True):
+        super().__init__(concurrency)
+        self.http1 = http1
+
+    def get_client(self):
+        import httpx
+
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http1=self.http1,
+                http2=True,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self.concurrency),
+            )
+        return self.client
+
+    async def fetch(
+        self, url: str, headers: dict | None = None, max_bytes: int | None = None
+    ):
+        client = self.get_client()
+        if max_bytes is None:
+            return await client.get(url, headers=headers)
+
+        async with client.stream("GET", url, headers=headers) as response:
+            body = response.aiter_bytes(64 * 1024)
+            try:
+                check_size(content_length(response.headers), max_bytes)
+                chunks, size = [], 0
+                async for chunk in body:
+                    size += len(chunk)
+                    check_size(size, max_bytes)
+                    chunks.append(chunk)
+            except PayloadTooLarge:
+                # httpx neither resets an HTTP/2 stream it stops reading nor
+                # credits its data to the connection window, which would
+                # stall every other stream on the connection. The rest of
+                # the body is read and dropped instead.
+                if response.http_version == "HTTP/2":
+                    async for _ in body:
+                        pass
+                raise
+            return Response(
+                response.status_code,
+                b"".join(chunks),
+                response.headers,
+                response.encoding,
+            )
+
+    async def fetch_head(self, url: str, headers: dict | None = None):
+        response = await self.get_client().head(url, headers=headers)
+        return content_length(response.headers) if response.is_success else None
+
+    async def close_client(self):
+        await self.client.aclose()
+
+
+TRANSPORTS = {
+    transport.name: transport
+    for transport in (RequestsTransport, AiohttpTransport, HttpxTransport)
+}
+
+
+def get_transport(transport=None, **kwargs):
+    """
+    Returns a transport instance for the given transport or backend name.
+
+    Parameters
+    ----------
+    transport : Transport | str | None
+        a transport instance, returned as is, or one of the names in
+        TRANSPORTS; None selects the requests backend
+    **kwargs
+        arguments passed to the transport class
+
+    Returns
+    -------
+    Transport
+        the transport instance
+    """
+    if isinstance(transport, Transport):
+        return transport
+    if transport is None:
+        transport = RequestsTransport.name
+    if transport not in TRANSPORTS:
+        raise ValueError(
+            f"Unknown transport: {transport}; choose from {', '.join(TRANSPORTS)}"
+        )
+    return TRANSPORTS[transport](**kwargs)